@@ -1,3 +1,9 @@
+import multiprocessing
+if __name__ == "__main__":
+    # No executável (PyInstaller), os processos auxiliares da extração de CATMAT reexecutam este
+    # script: freeze_support() os desvia aqui, antes de importar o Gradio e montar a interface
+    multiprocessing.freeze_support()
+
 import gradio as gr
 import os
 import shutil
@@ -5,6 +11,7 @@ import sys
 import gradio as gr 
 import ctypes
 import pandas as pd
+from contextlib import closing
 # --- CORREÇÃO PARA O ERRO UVICORN/PYINSTALLER ---
 if sys.stdout is None:
     class NullWriter:
@@ -37,9 +44,10 @@ def encerrar_sistema():
 
 # Importa todas as funções de automação
 from automacao_core import (
-    PASTA_ENTRADA, PASTA_DOWNLOAD, PASTA_OUTPUT, PASTA_DETALHADO, GLOBAL_STATE, 
-    ler_dados, verificar_necessidade_atualizacao, 
-    corrigir_valor_ipca_selenium, concatena_pdf,
+    PASTA_ENTRADA, PASTA_DOWNLOAD, PASTA_OUTPUT, PASTA_DETALHADO, GLOBAL_STATE, AGENDADOR_BCB,
+    LIMITE_MEMORIA_PDF_MB, PIKEPDF_DISPONIVEL, BufferEvidencias, otimizar_pdf,
+    ler_dados, verificar_necessidade_atualizacao, agrupar_itens_equivalentes,
+    corrigir_valor_ipca_selenium, corrigir_lote_ipca_selenium, concatena_pdf, ResumoExecucao,
     obter_caminho_base, buscar_codigo, read_pdf_text,
     renomeia_detalhado_catmat, renomeia_fonte_precos
 ) 
@@ -51,6 +59,11 @@ os.makedirs(PASTA_OUTPUT, exist_ok=True)
 os.makedirs(PASTA_DETALHADO, exist_ok=True)
 TEMPLATE_PATH = "template_ipca.xlsx"
 
+# Opções da interface -> níveis aceitos por 'otimizar_pdf'
+OPCOES_OTIMIZACAO = {"Desligada": None, "Rápida": "rapido", "Equilibrada": "equilibrado", "Máxima": "maximo"}
+# Sem o pikepdf não há otimização: a opção fica oculta e desligada
+OTIMIZACAO_PADRAO = "Equilibrada" if PIKEPDF_DISPONIVEL else "Desligada"
+
 
 # --- Funções de Wrapper para a Interface Gradio ---
 
@@ -66,7 +79,7 @@ def limpar_pastas_temp():
         for arquivo in os.listdir(pasta):
             os.remove(os.path.join(pasta, arquivo))
 
-def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True, periodo_atualizacao=60, auto_extrair_catmat=True, fonte="Compras.gov"):
+def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True, periodo_atualizacao=60, auto_extrair_catmat=True, fonte="Compras.gov", modo_lote=True, pdfs_em_memoria=True, limite_memoria_mb=LIMITE_MEMORIA_PDF_MB, otimizacao=OTIMIZACAO_PADRAO, usar_cache=True):
     """
     Executa a automação baseada no tipo de arquivo principal e usa a lista_pdfs_base 
     para concatenar os resultados.
@@ -76,6 +89,7 @@ def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True,
     yield "Iniciando automação... Limpando pastas temporárias", None
 
     GLOBAL_STATE.reset()
+    AGENDADOR_BCB.reset_metricas()
 
     # 1. Copiar Arquivos para a PASTA_ENTRADA (Ambiente de Trabalho)
     
@@ -96,7 +110,10 @@ def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True,
     # Se a extração automática estiver habilitada, renomeia os PDFs detalhados
     # Para permitir o usuário renomear manualmente se necessário
     if auto_extrair_catmat and fonte == "Compras.gov":
-        renomeia_detalhado_catmat(PASTA_DETALHADO)
+        yield "Extraindo códigos CATMAT dos relatórios detalhados...", None
+        relatorio_renomeacao = renomeia_detalhado_catmat(PASTA_DETALHADO)
+        if relatorio_renomeacao:
+            yield "Relatórios detalhados:\n" + "\n".join(relatorio_renomeacao), None
     
     if fonte == "Fonte de Preços":
         yield "Renomeando arquivos detalhados com base na Fonte de Preços...", None
@@ -109,7 +126,7 @@ def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True,
             efiscos_com_pdf_base.add(arq_renomeado.replace('.pdf', ''))
     # 2. Ler Dados e Obter Estrutura (Dados a serem corrigidos)
     
-    dados_a_corrigir = ler_dados(caminho_principal, fonte=fonte)
+    dados_a_corrigir = ler_dados(caminho_principal, fonte=fonte, usar_cache=usar_cache)
     
     if not dados_a_corrigir:
         yield "ERRO: Falha ao ler dados do arquivo principal ou arquivo vazio/inválido.", None
@@ -121,24 +138,54 @@ def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True,
     total_dados = len(dados_completos)
 
     total_a_atualizar = len(itens_a_corrigir)
+    resumo_execucao = ResumoExecucao()
+    # PDFs de evidência ficam em memória até a concatenação (gravados em disco só acima do limite).
+    # Campo vazio usa o limite padrão; limite zero ou negativo grava direto em disco.
+    if limite_memoria_mb is None:
+        limite_memoria_mb = LIMITE_MEMORIA_PDF_MB
+    buffer = BufferEvidencias(int(limite_memoria_mb * 1024 * 1024)) if pdfs_em_memoria and limite_memoria_mb > 0 else None
     if total_a_atualizar > 0:
-        yield f"Encontrados {total_a_atualizar} itens para atualizar. Iniciando correção de IPCA...", None
+        # Itens com mesmo código, valor e mês base são corrigidos uma única vez
+        grupos = agrupar_itens_equivalentes(dados_completos)
+        total_grupos = len(grupos)
+        yield f"Encontrados {total_a_atualizar} itens para atualizar ({total_grupos} correções distintas). Iniciando correção de IPCA...", None
         
-        itens_restantes = total_a_atualizar
-        # O índice 'i' deve ser único em todos os dados lidos
-        for i, item in enumerate(dados_completos):
+        grupos_restantes = total_grupos
+        if modo_lote:
+            # Mantém a calculadora aberta e corrige todos os grupos em sequência
+            with closing(corrigir_lote_ipca_selenium(grupos, mostrar_browser, buffer)) as correcoes:
+                for grupo, resultado in correcoes:
+                    resumo_execucao.adicionar(resultado)
+                    grupos_restantes -= 1
+                    ids = ", ".join(str(item_id) for item_id in resultado.item_ids)
+                    yield f"Itens {ids} (Codigo {grupo['efisco']}) processados em lote: {resultado.status}. Correções restantes: {grupos_restantes}.", None
+
+                    # Verifica se o usuário solicitou a interrupção
+                    if GLOBAL_STATE.should_stop:
+                        if buffer is not None:
+                            buffer.descarregar()
+                        yield "Execução interrompida pelo usuário.", None
+                        return
+        else:
+            pulados = total_dados - total_a_atualizar
+            for grupo in grupos:
 
-            # Verifica se o usuário solicitou a interrupção
-            if GLOBAL_STATE.should_stop:
-                yield "Execução interrompida pelo usuário.", None
-                return 
+                # Verifica se o usuário solicitou a interrupção
+                if GLOBAL_STATE.should_stop:
+                    if buffer is not None:
+                        buffer.descarregar()
+                    yield "Execução interrompida pelo usuário.", None
+                    return 
 
-            item_id = i + 1
-            pulados = total_dados - total_a_atualizar
-            if item['status'] == 'Atualizar':
-                yield f"Primeiros {pulados} itens não necessitam atualização. Atualizando item {item_id}/{len(dados_completos)} (Codigo {item['efisco']}). Restantes: {itens_restantes - 1}.", None
-                corrigir_valor_ipca_selenium(item, item_id, mostrar_browser)
-                itens_restantes -= 1
+                item_id = grupo['membros'][0][0]
+                yield f"Primeiros {pulados} itens não necessitam atualização. Atualizando item {item_id}/{total_dados} (Codigo {grupo['efisco']}, {len(grupo['membros'])} item(ns) equivalente(s)). Correções restantes: {grupos_restantes - 1}.", None
+                resumo_execucao.adicionar(corrigir_valor_ipca_selenium(grupo, item_id, mostrar_browser, membros=grupo['membros'], buffer=buffer))
+                grupos_restantes -= 1
+
+        yield resumo_execucao.texto(), None
+        metricas_bcb = AGENDADOR_BCB.resumo()
+        if metricas_bcb:
+            yield "Requisições ao BCB -> " + " | ".join(metricas_bcb), None
 
     else:
         print("\nNenhum item precisou de atualização.")
@@ -148,20 +195,35 @@ def executar_automacao(arquivo_principal, lista_pdfs_base, mostrar_browser=True,
     codigos_para_concatenar = set(item['efisco'] for item in dados_completos)
 
     arquivos_finais_gerados = []
+    evidencias = resumo_execucao.evidencias()
     
     yield f"\nIniciando concatenação de PDFs para {len(codigos_para_concatenar)} códigos...", None    
     for codigo in codigos_para_concatenar:
         if codigo in efiscos_com_pdf_base: 
             # Chama a função de concatenação com todos os dados para obter a ordem correta
-            concatena_pdf(codigo, dados_completos)
+            gerado = concatena_pdf(codigo, dados_completos, evidencias, buffer)
             yield f"Concatenando PDF completo para EFISCO {codigo}...", None
             # Adiciona o caminho do arquivo gerado para o retorno do Gradio
-            caminho_saida = os.path.join(PASTA_OUTPUT, f"{codigo}_COMPLETO.pdf")
-            if os.path.exists(caminho_saida):
+            if gerado:
+                caminho_saida = os.path.join(PASTA_OUTPUT, f"{codigo}_COMPLETO.pdf")
+                nivel = OPCOES_OTIMIZACAO.get(otimizacao)
+                if nivel and PIKEPDF_DISPONIVEL:
+                    try:
+                        antes, depois = otimizar_pdf(caminho_saida, nivel)
+                        if depois >= antes:
+                            yield f"PDF de {codigo} não foi reduzido (arquivo já otimizado).", None
+                        else:
+                            yield f"PDF de {codigo} otimizado: {antes / 1024:.0f} KB -> {depois / 1024:.0f} KB ({(antes - depois) / 1024:.0f} KB economizados).", None
+                    except Exception as e:
+                        yield f"AVISO: Falha ao otimizar o PDF de {codigo}: {e}", None
                 arquivos_finais_gerados.append(caminho_saida)
         else:
             yield f"AVISO: PDF base '{codigo}.pdf' não fornecido. Concatenação ignorada.", None
 
+    # Evidências que não entraram em nenhum PDF completo também ficam salvas em disco
+    if buffer is not None and buffer.descarregar():
+        yield "PDFs de evidência não concatenados salvos na pasta de downloads.", None
+
     # 5. Retorno Final
     if arquivos_finais_gerados:
         yield f"SUCESSO! {len(arquivos_finais_gerados)} arquivos completos gerados na pasta de saída.", arquivos_finais_gerados
@@ -212,6 +274,23 @@ with gr.Blocks(title="Automação de Correção de IPCA") as demo:
 
         auto_nome = gr.Checkbox(label="Extrair catmat automaticamente do documento", value=True, info="Habilite para renomear automaticamente os PDFs detalhados com base no código extraído do conteúdo do PDF. Desabilite no caso de estar usando arquivo que não seja do compras (Necessário renomear o(s) arquivo(s) com o(s) código(s) usado(s) no arquivo da entrada principal).")
 
+        usar_cache = gr.Checkbox(label="Reaproveitar leitura de arquivos já enviados", value=True, info="Se o mesmo arquivo principal já foi lido antes, carrega os itens do cache em vez de processá-lo de novo.")
+
+        modo_lote = gr.Checkbox(label="Corrigir em lote", value=True, info="Mantém a calculadora do BCB aberta e corrige todos os itens em sequência, sem recarregar a página a cada item.")
+
+        with gr.Row():
+            pdfs_em_memoria = gr.Checkbox(label="Manter PDFs de evidência em memória", value=True, info="Evita gravar e reler cada PDF do BCB antes da concatenação.")
+            limite_memoria = gr.Number(label="Limite de memória para PDFs (MB)", value=LIMITE_MEMORIA_PDF_MB, interactive=True)
+
+        otimizacao = gr.Radio(
+            choices=list(OPCOES_OTIMIZACAO),
+            label="Otimização do PDF final (tamanho x tempo)",
+            value=OTIMIZACAO_PADRAO,
+            visible=PIKEPDF_DISPONIVEL,
+            interactive=PIKEPDF_DISPONIVEL,
+            info="Comprime e remove conteúdo repetido (fontes, logos) dos arquivos _COMPLETO.pdf. 'Máxima' também lineariza o arquivo."
+        )
+
         # Entrada dos PDFs (Múltipla Seleção)
         pdf_reports = gr.Files(label="Cotação Detalhado", file_types=[".pdf"])
 
@@ -226,7 +305,7 @@ with gr.Blocks(title="Automação de Correção de IPCA") as demo:
 
         btn_excel_run.click(
             fn=executar_automacao, 
-            inputs=[main_file, pdf_reports, mostrar_browser, periodo_atualizacao, auto_nome, selecao_fonte], 
+            inputs=[main_file, pdf_reports, mostrar_browser, periodo_atualizacao, auto_nome, selecao_fonte, modo_lote, pdfs_em_memoria, limite_memoria, otimizacao, usar_cache], 
             outputs=[output_text, output_files_text]
         )
 
@@ -2,12 +2,18 @@ import sys
 import os
 import glob
 import base64
+import time
+import random
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.support.ui import Select
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from dateutil.relativedelta import relativedelta
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.chrome.options import Options
@@ -15,57 +21,24 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import pandas as pd
 import camelot
+from openpyxl import load_workbook
 import numpy as np
 from PyPDF2 import PdfWriter, PdfReader
 import re
 import io
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
+import hashlib
 
-def read_pdf_text(file_path):
-    """Lê o texto de um arquivo PDF e retorna como uma string."""
-    texto_completo = ""
-    try:
-        with open(file_path, 'rb') as file:
-            reader = PdfReader(file)
-            for page in reader.pages:
-                texto_completo += page.extract_text() + "\n"
-    except Exception as e:
-        print(f"Erro ao ler o PDF {file_path}: {e}")
-    return texto_completo
+# Leitura do código nos PDFs fica em módulo leve, importado também pelos processos auxiliares
+from extracao_catmat import read_pdf_text, buscar_codigo, extrair_codigo_arquivo
 
-def buscar_codigo(file_path, palavra_chave_1= "Quantidade", palavra_chave_2= "-", distancia_max_chars=100):
-    """
-    Busca a palavra_chave_1 próxima à palavra_chave_2.
-    Retorna o trecho de texto encontrado.
-    Baseado no formato do PDF gerado pelo Compras.gov.br
-    """
-    texto = read_pdf_text(file_path)
-    # 1. Escapar caracteres especiais para RegEx
-    chave_1_escapada = re.escape(palavra_chave_1)
-    chave_2_escapada = re.escape(palavra_chave_2)
-    
-    # 2. Construir a expressão regular
-    # Padrão: CHAVE_1, seguida por 0 a N caracteres (qualquer coisa), seguida por CHAVE_2
-    padrao = re.compile(
-        # Captura CHAVE_1
-        rf"({chave_1_escapada})"
-        # Captura o contexto entre (distância máxima de caracteres)
-        r"([\s\S]{0," + str(distancia_max_chars) + r"}?)"
-        # Captura CHAVE_2
-        rf"({chave_2_escapada})",
-        re.IGNORECASE | re.DOTALL # Ignora maiúsculas/minúsculas e permite que . case com newline
-    )
-    
-    # 3. Executar a busca
-    encontrados = []
-    for match in padrao.finditer(texto):
-        # match.group(0) contém o trecho completo: Chave 1 + Contexto + Chave 2
-        encontrados.append(match.group(0).strip())
-    
-    codigo = encontrados[0].split("\n")[1]
-    codigo = codigo.split(" ")[0].strip()
-    return codigo
+try:
+    # Opcional: permite object streams, deduplicação e linearização na otimização dos PDFs finais
+    import pikepdf
+except ImportError:
+    pikepdf = None
+PIKEPDF_DISPONIVEL = pikepdf is not None
 
 # --- 1. Função para garantir que os caminhos funcionem no .EXE ---
 def obter_caminho_base():
@@ -84,16 +57,114 @@ PASTA_ENTRADA = os.path.join(BASE_DIR, "Dados de entrada")
 PASTA_DOWNLOAD = os.path.join(BASE_DIR, "downloads_pdf")
 PASTA_OUTPUT = os.path.join(BASE_DIR, "output")
 PASTA_DETALHADO = os.path.join(BASE_DIR, "relatorio_detalhado")
+PASTA_CACHE = os.path.join(BASE_DIR, "cache_entrada")
 os.makedirs(PASTA_DOWNLOAD, exist_ok=True)
 os.makedirs(PASTA_OUTPUT, exist_ok=True)
+os.makedirs(PASTA_CACHE, exist_ok=True)
+
+# Limite padrão de memória para os PDFs de evidência mantidos em memória (ver BufferEvidencias)
+LIMITE_MEMORIA_PDF_MB = 256
+
+# Níveis aceitos por 'otimizar_pdf' (do mais rápido ao que gera o menor arquivo)
+NIVEIS_OTIMIZACAO_PDF = ("rapido", "equilibrado", "maximo")
+
+# Cache dos dados de entrada já interpretados (ver 'ler_dados').
+# Incrementar a versão sempre que a leitura dos arquivos mudar, para invalidar o cache antigo.
+VERSAO_LEITOR_ENTRADA = "2"
+LIMITE_CACHE_ENTRADA_MB = 50
 
 
 # --- Funções do Script ---
 
-def ler_dados(caminho_arquivo_input:str, fonte = "Compras.gov"):
+def chave_cache_entrada(caminho_arquivo, fonte):
+    """Chave do cache: hash do conteúdo do arquivo + versão do leitor + opção de fonte."""
+    h = hashlib.sha256()
+    with open(caminho_arquivo, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloco)
+    extensao = os.path.splitext(caminho_arquivo)[1].lower()
+    h.update(f"|{VERSAO_LEITOR_ENTRADA}|{fonte}|{extensao}".encode())
+    return h.hexdigest()
+
+def ler_cache_entrada(chave):
+    """Retorna a lista de itens guardada para a chave, ou None se não estiver em cache."""
+    caminho_cache = os.path.join(PASTA_CACHE, f"{chave}.npz")
+    if not os.path.exists(caminho_cache):
+        return None
+    with np.load(caminho_cache, allow_pickle=False) as dados:
+        efiscos = dados['efisco'].tolist()
+        valores = dados['valor'].tolist()
+        datas = dados['data_base'].astype(object).tolist()
+    # Atualiza a data de modificação: o cache descarta primeiro os menos usados
+    os.utime(caminho_cache)
+    return [
+        {'efisco': e, 'valor': v, 'data_base': d}
+        for e, v, d in zip(efiscos, valores, datas)
+    ]
+
+def salvar_cache_entrada(chave, lista_itens, limite_mb=LIMITE_CACHE_ENTRADA_MB):
+    """
+    Guarda a lista de itens em formato colunar compactado (.npz, uma coluna por campo)
+    e remove as entradas mais antigas se o cache passar de 'limite_mb'.
+    """
+    caminho_cache = os.path.join(PASTA_CACHE, f"{chave}.npz")
+    caminho_temp = caminho_cache + ".tmp"
+    with open(caminho_temp, 'wb') as f:
+        np.savez_compressed(
+            f,
+            efisco=np.array([str(item['efisco']) for item in lista_itens]),
+            valor=np.array([item['valor'] for item in lista_itens], dtype=np.float64),
+            data_base=np.array([item['data_base'] for item in lista_itens], dtype='datetime64[D]')
+        )
+    os.replace(caminho_temp, caminho_cache)
+    limitar_cache_entrada(limite_mb * 1024 * 1024)
+
+def limitar_cache_entrada(limite_bytes):
+    """Apaga as entradas usadas há mais tempo até o cache caber em 'limite_bytes'."""
+    entradas = [os.path.join(PASTA_CACHE, arq) for arq in os.listdir(PASTA_CACHE) if arq.endswith(".npz")]
+    entradas.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(e) for e in entradas)
+    for entrada in entradas:
+        if total <= limite_bytes:
+            break
+        total -= os.path.getsize(entrada)
+        os.remove(entrada)
+
+def ler_dados(caminho_arquivo_input:str, fonte = "Compras.gov", excel_rapido=True, usar_cache=True):
     """
     Obtém os dados do arquivo de entrada (Excel, CSV ou PDF) e retorna uma lista de dicionários.
     Cada dicionário contém as chaves: 'efisco', 'valor', 'data_base'
+    Com usar_cache=True, um arquivo já lido antes (mesmo conteúdo e mesma fonte) é carregado
+    do cache em disco, sem repetir a leitura de PDF/CSV/Excel.
+    """
+    if not usar_cache or not os.path.exists(caminho_arquivo_input):
+        return interpretar_entrada(caminho_arquivo_input, fonte, excel_rapido)
+
+    try:
+        chave = chave_cache_entrada(caminho_arquivo_input, fonte)
+        lista_itens = ler_cache_entrada(chave)
+    except Exception as e:
+        print(f"AVISO: Cache de entrada indisponível ({e}).")
+        chave, lista_itens = None, None
+
+    if lista_itens is not None:
+        print(f"Dados de {os.path.basename(caminho_arquivo_input)} carregados do cache ({len(lista_itens)} itens).")
+        return lista_itens
+
+    lista_itens = interpretar_entrada(caminho_arquivo_input, fonte, excel_rapido)
+    if chave and isinstance(lista_itens, list) and lista_itens:
+        try:
+            salvar_cache_entrada(chave, lista_itens)
+        except Exception as e:
+            print(f"AVISO: Não foi possível salvar o cache de entrada ({e}).")
+    return lista_itens
+
+def interpretar_entrada(caminho_arquivo_input:str, fonte = "Compras.gov", excel_rapido=True):
+    """
+    Lê e interpreta o arquivo de entrada (Excel, CSV ou PDF), sem cache (ver 'ler_dados').
+    Retorna uma lista de dicionários com as chaves: 'efisco', 'valor', 'data_base'
+    Com excel_rapido=True, o Excel é lido por 'ler_excel_rapido' (só as colunas mapeadas);
+    se falhar, usa a leitura completa com pandas.
 
     """
     # 1. Tenta encontrar arquivos
@@ -218,6 +289,12 @@ def ler_dados(caminho_arquivo_input:str, fonte = "Compras.gov"):
     nome_arquivo_usado = os.path.basename(caminho_arquivo)
     print(f"Lendo o primeiro arquivo encontrado ({tipo_arquivo}): {nome_arquivo_usado}")
 
+    if excel_rapido:
+        try:
+            return ler_excel_rapido(caminho_arquivo, mapa_colunas)
+        except Exception as e:
+            print(f"Leitura rápida do Excel falhou ({e}). Usando leitura completa com pandas.")
+
     try:
         df = pd.read_excel(caminho_arquivo)
         
@@ -272,6 +349,69 @@ def ler_dados(caminho_arquivo_input:str, fonte = "Compras.gov"):
         print(f"Erro ao abrir/processar arquivo: {e}")
         return []
 
+def ler_excel_rapido(caminho_arquivo, mapa_colunas):
+    """
+    Lê a primeira aba do Excel em modo somente leitura (openpyxl), percorrendo as linhas sem
+    carregar a planilha inteira e extraindo só as colunas mapeadas.
+    As conversões de tipo são feitas em bloco com pandas. Retorna a mesma lista de dicionários de 'ler_dados'.
+    """
+    wb = load_workbook(caminho_arquivo, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        # Ignora a dimensão gravada no arquivo (pode estar desatualizada e esconder linhas),
+        # como faz o leitor openpyxl do pandas
+        ws.reset_dimensions()
+        cabecalho = next(ws.iter_rows(max_row=1, values_only=True), None)
+        if cabecalho is None:
+            return []
+        cabecalho = [str(c).upper().strip() if c is not None else "" for c in cabecalho]
+
+        # Posição (0-based) de cada coluna mapeada
+        indices = {}
+        for nome_original, nome_novo in mapa_colunas.items():
+            if nome_original not in cabecalho:
+                raise KeyError(f"Coluna '{nome_original}' não encontrada na planilha.")
+            indices[nome_novo] = cabecalho.index(nome_original)
+
+        # Lê apenas o intervalo de colunas que contém as colunas mapeadas
+        primeira = min(indices.values())
+        ultima = max(indices.values())
+        colunas = {nome_novo: [] for nome_novo in indices}
+        for linha in ws.iter_rows(min_row=2, min_col=primeira + 1, max_col=ultima + 1, values_only=True):
+            for nome_novo, indice in indices.items():
+                posicao = indice - primeira
+                colunas[nome_novo].append(linha[posicao] if posicao < len(linha) else None)
+    finally:
+        wb.close()
+
+    df = pd.DataFrame(colunas)
+    if df.empty:
+        return []
+
+    # Conversão em bloco (equivalente ao str(int(...)) / float(...) / strptime por célula)
+    efisco = pd.to_numeric(df['efisco'], errors='coerce')
+    valor = pd.to_numeric(df['valor'], errors='coerce')
+
+    datas = df['data_base']
+    eh_texto = datas.map(lambda v: isinstance(v, str))
+    data_base = pd.to_datetime(datas.where(~eh_texto), errors='coerce')
+    data_base = data_base.fillna(pd.to_datetime(datas.where(eh_texto), format='%d/%m/%Y', errors='coerce'))
+
+    linhas_vazias = df['efisco'].isna() | df['valor'].isna()
+    validos = efisco.notna() & valor.notna() & data_base.notna()
+    invalidos = int((~validos & ~linhas_vazias).sum())
+    if invalidos:
+        print(f"Erro ao processar: {invalidos} linha(s) com código, valor ou data inválidos foram ignoradas.")
+
+    efisco = efisco[validos].astype('int64').astype(str)
+    valor = valor[validos].astype(float)
+    data_base = data_base[validos].dt.date
+
+    return [
+        {'efisco': e, 'valor': v, 'data_base': d}
+        for e, v, d in zip(efisco.tolist(), valor.tolist(), data_base.tolist())
+    ]
+
 def verificar_necessidade_atualizacao(dados, periodo= 60):
     """
     Verifica quais itens precisam de atualização com base no período fornecido (em dias).
@@ -294,27 +434,156 @@ def verificar_necessidade_atualizacao(dados, periodo= 60):
     print(itens_para_atualizar, dados)
     return itens_para_atualizar, dados
 
-def gerar_pdf_cdp(driver, efisco, data_base, pasta_destino, item_id):
+@dataclass(slots=True)
+class ResultadoCorrecao:
+    """
+    Resultado da correção de um item (ou de um grupo de itens equivalentes) na calculadora do BCB.
+    status: 'sucesso', 'sem_atualizacao' (mês final igual ao mês base) ou 'erro'.
+    meses_atras: quantos meses antes do atual ficou o mês final usado (1 = mês passado).
     """
-    Gera o PDF de atualização de preço via Chrome DevTools Protocol (CDP) e adiciona um rodapé com informações.
+    efisco: str
+    item_ids: list
+    valor_original: float
+    status: str = 'erro'
+    valor_corrigido: float | None = None
+    fator: float | None = None
+    mes_final: str | None = None
+    meses_atras: int | None = None
+    caminhos_pdf: dict = field(default_factory=dict)
+    tentativas: int = 0
+    duracao: float = 0.0
+    mensagem: str = ''
+
+@dataclass(slots=True)
+class ResumoExecucao:
+    """Agrega os resultados de uma execução e calcula métricas de vazão e falhas."""
+    resultados: list = field(default_factory=list)
+    inicio: float = field(default_factory=time.perf_counter)
+
+    def adicionar(self, resultado):
+        self.resultados.append(resultado)
+
+    def contagem(self, status):
+        return sum(1 for r in self.resultados if r.status == status)
+
+    def evidencias(self):
+        """Retorna {item_id: caminho do PDF} de todos os itens corrigidos."""
+        caminhos = {}
+        for resultado in self.resultados:
+            caminhos.update(resultado.caminhos_pdf)
+        return caminhos
+
+    def texto(self):
+        """Resumo legível para o log da interface."""
+        total = len(self.resultados)
+        if not total:
+            return "Nenhuma correção executada."
+        tempo_total = time.perf_counter() - self.inicio
+        tentativas = sum(r.tentativas for r in self.resultados)
+        tempo_medio = sum(r.duracao for r in self.resultados) / total
+        por_minuto = total / tempo_total * 60 if tempo_total else 0.0
+        return (
+            f"{total} correções: {self.contagem('sucesso')} com sucesso, "
+            f"{self.contagem('sem_atualizacao')} sem atualização possível, {self.contagem('erro')} com erro. "
+            f"{tentativas} envios ao BCB, {tempo_medio:.1f}s por correção ({por_minuto:.1f} correções/min)."
+        )
+
+def agrupar_itens_equivalentes(dados):
+    """
+    Agrupa os itens marcados para 'Atualizar' que têm o mesmo código, o mesmo valor
+    e a data base no mesmo mês. Como a calculadora só considera mês/ano, esses itens
+    têm a mesma correção e podem ser enviados ao BCB uma única vez.
+    Retorna uma lista de grupos (na ordem da primeira ocorrência), cada um com as chaves
+    'efisco', 'valor', 'data_base' e 'membros' (lista de tuplas (item_id, item)).
+    """
+    grupos = {}
+    for i, item in enumerate(dados):
+        if item['status'] != 'Atualizar':
+            continue
+        item_id = i + 1
+        chave = (item['efisco'], round(item['valor'], 2), item['data_base'].year, item['data_base'].month)
+        if chave not in grupos:
+            grupos[chave] = {
+                'efisco': item['efisco'],
+                'valor': item['valor'],
+                'data_base': item['data_base'],
+                'membros': []
+            }
+        grupos[chave]['membros'].append((item_id, item))
+    return list(grupos.values())
+
+class BufferEvidencias:
+    """
+    Mantém em memória os PDFs de evidência já carimbados, indexados pelo caminho onde seriam salvos.
+    Quando o total ultrapassa 'limite_bytes', os PDFs mais antigos são gravados nesse caminho
+    e liberados da memória.
+    """
+    def __init__(self, limite_bytes):
+        self.limite_bytes = limite_bytes
+        self._pdfs = {}
+        self._total = 0
+
+    def guardar(self, caminho, dados):
+        """Guarda os bytes do PDF e descarrega para o disco o que passar do limite de memória."""
+        self.liberar(caminho)
+        self._pdfs[caminho] = dados
+        self._total += len(dados)
+        while self._total > self.limite_bytes and self._pdfs:
+            caminho_antigo = next(iter(self._pdfs))
+            with open(caminho_antigo, 'wb') as f:
+                f.write(self._pdfs[caminho_antigo])
+            self.liberar(caminho_antigo)
+            print(f"   -> Limite de memória atingido: {os.path.basename(caminho_antigo)} gravado em disco.")
+
+    def abrir(self, caminho):
+        """Retorna um fluxo em memória se o PDF estiver no buffer; caso contrário, o próprio caminho."""
+        dados = self._pdfs.get(caminho)
+        if dados is None:
+            return caminho
+        return io.BytesIO(dados)
+
+    def liberar(self, caminho):
+        """Remove o PDF da memória (se estiver lá)."""
+        dados = self._pdfs.pop(caminho, None)
+        if dados is not None:
+            self._total -= len(dados)
+
+    def descarregar(self):
+        """
+        Grava em disco todos os PDFs que ainda estão em memória (ex.: códigos sem relatório base
+        ou execução interrompida), para que nenhuma evidência se perca. Retorna quantos foram gravados.
+        """
+        caminhos = list(self._pdfs)
+        for caminho in caminhos:
+            with open(caminho, 'wb') as f:
+                f.write(self._pdfs[caminho])
+            self.liberar(caminho)
+        return len(caminhos)
+
+def imprimir_pagina_cdp(driver):
+    """Imprime a página atual via Chrome DevTools Protocol (CDP) e retorna os bytes do PDF."""
+    params = {
+        'landscape': False,
+        'displayHeaderFooter': False,
+        'printBackground': True,
+        'paperWidth': 8.27,
+        'paperHeight': 11.69,
+        'marginTop': 0.4,
+        'marginBottom': 0.4,
+        'marginLeft': 0.4,
+        'marginRight': 0.4
+    }
     
+    resultado = driver.execute_cdp_cmd("Page.printToPDF", params)
+    return base64.b64decode(resultado['data'])
+
+def carimbar_pdf(pdf_bytes, efisco, data_base, pasta_destino, item_id, buffer=None):
+    """
+    Adiciona o rodapé com o identificador do item ao PDF impresso e salva na pasta de destino.
+    Com 'buffer' (BufferEvidencias), o PDF fica em memória até a concatenação.
+    Retorna o caminho do arquivo (salvo ou reservado no buffer) ou None em caso de erro.
     """
     try:
-        params = {
-            'landscape': False,
-            'displayHeaderFooter': False,
-            'printBackground': True,
-            'paperWidth': 8.27,
-            'paperHeight': 11.69,
-            'marginTop': 0.4,
-            'marginBottom': 0.4,
-            'marginLeft': 0.4,
-            'marginRight': 0.4
-        }
-        
-        resultado = driver.execute_cdp_cmd("Page.printToPDF", params)
-        pdf_bytes = base64.b64decode(resultado['data'])
-
         packet = io.BytesIO()
         can = canvas.Canvas(packet, pagesize=A4)
         can.setStrokeColorRGB(0.7, 0.7, 0.7)
@@ -343,21 +612,178 @@ def gerar_pdf_cdp(driver, efisco, data_base, pasta_destino, item_id):
         caminho_completo = os.path.join(pasta_destino, nome_arquivo)
         
 
+        if buffer is not None:
+            dados = io.BytesIO()
+            output.write(dados)
+            buffer.guardar(caminho_completo, dados.getvalue())
+            print(f"   -> PDF EM MEMÓRIA: {nome_arquivo}")
+            return caminho_completo
+
         with open(caminho_completo, 'wb') as f:
             output.write(f)
             
         print(f"   -> PDF SALVO: {nome_arquivo}")
-        return True
+        return caminho_completo
         
+    except Exception as e:
+        print(f"   -> ERRO ao carimbar PDF do item {item_id}: {e}")
+        return None
+
+def gerar_pdfs_membros(driver, membros, pasta_destino, buffer=None):
+    """
+    Imprime o resultado uma única vez e gera um PDF carimbado para cada item do grupo,
+    mantendo o nome de arquivo por item_id esperado por 'concatena_pdf'.
+    Retorna {item_id: caminho} dos PDFs salvos.
+    """
+    try:
+        pdf_bytes = imprimir_pagina_cdp(driver)
     except Exception as e:
         print(f"   -> ERRO ao gerar PDF via CDP: {e}")
-        return False
+        return {}
+    caminhos = {}
+    for item_id, membro in membros:
+        caminho = carimbar_pdf(pdf_bytes, membro['efisco'], membro['data_base'], pasta_destino, item_id, buffer)
+        if caminho:
+            caminhos[item_id] = caminho
+    return caminhos
+
+def eh_falha_transitoria(erro):
+    """
+    Indica se o erro do Selenium é uma falha transitória de rede/carregamento,
+    que vale a pena repetir no mesmo mês (ao contrário do 'mês ainda não publicado').
+    """
+    if isinstance(erro, TimeoutException):
+        return True
+    if isinstance(erro, WebDriverException):
+        mensagem = str(erro)
+        return "net::ERR_" in mensagem or "timed out" in mensagem.lower()
+    return False
 
-def corrigir_valor_ipca_selenium(item, item_id, mostrar_browser=True):
+class AgendadorRequisicoes:
     """
-    Usa Selenium para acessar a calculadora do BCB e corrigir o valor pelo IPCA.
-    Gera o PDF do resultado e salva na pasta de downloads.
+    Ponto único de passagem das requisições à calculadora do BCB.
+    - Limita a taxa de requisições com um token bucket (ajustado conforme o servidor responde);
+    - Repete falhas transitórias com backoff exponencial e jitter;
+    - Pausa as requisições (circuito aberto) após muitas falhas seguidas;
+    - Registra latência e taxa de erro por endpoint.
     """
+    def __init__(self, taxa_por_segundo=1.0, taxa_minima=0.2, taxa_maxima=2.0, capacidade=3,
+                 max_tentativas=4, espera_base=1.0, espera_maxima=30.0,
+                 limite_falhas_seguidas=5, pausa_circuito=60.0):
+        self.taxa_por_segundo = taxa_por_segundo
+        self.taxa_minima = taxa_minima
+        self.taxa_maxima = taxa_maxima
+        self.capacidade = capacidade
+        self.max_tentativas = max_tentativas
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.limite_falhas_seguidas = limite_falhas_seguidas
+        self.pausa_circuito = pausa_circuito
+
+        self._lock = threading.Lock()
+        self._tokens = float(capacidade)
+        self._ultima_reposicao = time.monotonic()
+        self._falhas_seguidas = 0
+        self._circuito_aberto_ate = 0.0
+        self.metricas = {}
+
+    def reset_metricas(self):
+        """Zera as métricas e o estado do circuito antes de uma nova execução."""
+        with self._lock:
+            self.metricas = {}
+            self._falhas_seguidas = 0
+            self._circuito_aberto_ate = 0.0
+
+    def _aguardar_token(self):
+        """Bloqueia até haver um token disponível no balde."""
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                decorrido = agora - self._ultima_reposicao
+                self._tokens = min(self.capacidade, self._tokens + decorrido * self.taxa_por_segundo)
+                self._ultima_reposicao = agora
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                espera = (1 - self._tokens) / self.taxa_por_segundo
+            time.sleep(espera)
+
+    def _aguardar_circuito(self):
+        """Se o circuito estiver aberto, espera a pausa terminar antes de liberar a requisição."""
+        with self._lock:
+            espera = self._circuito_aberto_ate - time.monotonic()
+        if espera > 0:
+            print(f"   -> AVISO: Muitas falhas seguidas no BCB. Aguardando {espera:.0f}s antes de continuar.")
+            time.sleep(espera)
+
+    def _registrar(self, endpoint, duracao, erro, transitoria=False):
+        """
+        Atualiza as métricas do endpoint e ajusta a taxa: aumento aditivo a cada sucesso,
+        redução pela metade a cada falha transitória.
+        """
+        with self._lock:
+            metrica = self.metricas.setdefault(endpoint, {'chamadas': 0, 'erros': 0, 'tempo_total': 0.0, 'tempo_max': 0.0})
+            metrica['chamadas'] += 1
+            metrica['tempo_total'] += duracao
+            metrica['tempo_max'] = max(metrica['tempo_max'], duracao)
+            if erro:
+                metrica['erros'] += 1
+            if transitoria:
+                self._falhas_seguidas += 1
+                self.taxa_por_segundo = max(self.taxa_minima, self.taxa_por_segundo / 2)
+                if self._falhas_seguidas >= self.limite_falhas_seguidas:
+                    self._circuito_aberto_ate = time.monotonic() + self.pausa_circuito
+                    self._falhas_seguidas = 0
+            elif not erro:
+                self._falhas_seguidas = 0
+                self.taxa_por_segundo = min(self.taxa_maxima, self.taxa_por_segundo + 0.1)
+
+    def executar(self, endpoint, funcao, *args, repetir=True, **kwargs):
+        """
+        Executa 'funcao' respeitando o limite de taxa e repetindo falhas transitórias.
+        Use repetir=False para ações que não podem ser refeitas (ex.: voltar no histórico).
+        Erros não transitórios (ou a última falha transitória) são repassados ao chamador.
+        """
+        max_tentativas = self.max_tentativas if repetir else 1
+        for tentativa in range(1, max_tentativas + 1):
+            self._aguardar_circuito()
+            self._aguardar_token()
+            inicio = time.perf_counter()
+            try:
+                resultado = funcao(*args, **kwargs)
+            except Exception as e:
+                transitoria = eh_falha_transitoria(e)
+                self._registrar(endpoint, time.perf_counter() - inicio, erro=True, transitoria=transitoria)
+                if not transitoria or tentativa == max_tentativas:
+                    raise
+                # Backoff exponencial com "full jitter"
+                espera = random.uniform(0, min(self.espera_maxima, self.espera_base * 2 ** (tentativa - 1)))
+                print(f"   -> Falha transitória em '{endpoint}' ({e.__class__.__name__}). Nova tentativa em {espera:.1f}s.")
+                time.sleep(espera)
+                continue
+            self._registrar(endpoint, time.perf_counter() - inicio, erro=False)
+            return resultado
+
+    def resumo(self):
+        """Retorna uma linha de texto por endpoint com chamadas, taxa de erro e latência."""
+        with self._lock:
+            linhas = []
+            for endpoint, metrica in self.metricas.items():
+                chamadas = metrica['chamadas']
+                taxa_erro = metrica['erros'] / chamadas * 100
+                latencia_media = metrica['tempo_total'] / chamadas
+                linhas.append(
+                    f"{endpoint}: {chamadas} chamadas, {taxa_erro:.0f}% erros, "
+                    f"latência média {latencia_media:.2f}s (máx {metrica['tempo_max']:.2f}s)"
+                )
+            return linhas
+
+AGENDADOR_BCB = AgendadorRequisicoes()
+
+URL_CALCULADORA = "https://www3.bcb.gov.br/CALCIDADAO/publico/exibirFormCorrecaoValores.do?method=exibirFormCorrecaoValores"
+
+def iniciar_driver(mostrar_browser=True):
+    """Cria o driver do Chrome usado para acessar a calculadora do BCB."""
     service = Service(ChromeDriverManager().install())
     
     opcoes = Options()
@@ -367,8 +793,103 @@ def corrigir_valor_ipca_selenium(item, item_id, mostrar_browser=True):
     
     driver = webdriver.Chrome(service=service, options=opcoes)
     driver.implicitly_wait(3) 
-    url_calculadora = "https://www3.bcb.gov.br/CALCIDADAO/publico/exibirFormCorrecaoValores.do?method=exibirFormCorrecaoValores" 
-    
+    return driver
+
+def carregar_formulario(driver):
+    """Carrega o formulário da calculadora do BCB e aguarda o seletor de índice aparecer."""
+    driver.get(URL_CALCULADORA)
+    WebDriverWait(driver, 10).until(
+        EC.presence_of_element_located((By.ID, 'selIndice'))
+    )
+
+def abrir_calculadora(driver):
+    """Carrega a calculadora passando pelo agendador (limite de taxa e novas tentativas)."""
+    AGENDADOR_BCB.executar('formulario', carregar_formulario, driver)
+
+def voltar_formulario(driver):
+    """
+    Volta da página de resultado para o formulário pelo histórico do navegador,
+    evitando baixar e renderizar a calculadora novamente.
+    Se o formulário não reaparecer, recarrega a página.
+    """
+    try:
+        AGENDADOR_BCB.executar('historico', driver.back, repetir=False)
+        WebDriverWait(driver, 5).until(
+            EC.presence_of_element_located((By.ID, 'selIndice'))
+        )
+    except TimeoutException:
+        abrir_calculadora(driver)
+
+def preencher_campo(driver, nome_campo, conteudo):
+    """Preenche um campo do formulário apenas se o valor atual for diferente do desejado."""
+    campo = driver.find_element(By.NAME, nome_campo)
+    # Os campos da calculadora usam máscara (ex.: 01/2024), então compara só os dígitos
+    valor_atual = re.sub(r"\D", "", campo.get_attribute('value') or "")
+    if valor_atual == re.sub(r"\D", "", conteudo):
+        return
+    campo.clear()
+    campo.send_keys(conteudo)
+
+def preencher_formulario(driver, data_origem_str, data_final_str, valor_a_enviar):
+    """
+    Preenche o formulário da calculadora já carregado.
+    Entre itens de um lote, normalmente só 'dataInicial' e 'valorCorrecao' mudam.
+    """
+    seletor_indice = Select(driver.find_element(By.ID, 'selIndice'))
+    if seletor_indice.first_selected_option.get_attribute('value') != "00433IPCA":
+        seletor_indice.select_by_value("00433IPCA")
+
+    preencher_campo(driver, 'dataInicial', data_origem_str)
+    preencher_campo(driver, 'dataFinal', data_final_str)
+    preencher_campo(driver, 'valorCorrecao', valor_a_enviar)
+
+def ler_resultado_calculadora(driver):
+    """
+    Extrai o valor corrigido e o índice de correção da página de resultado da calculadora.
+    Retorna (valor_corrigido, fator); o que não for encontrado volta como None.
+    """
+    try:
+        texto = driver.find_element(By.TAG_NAME, 'body').text
+    except Exception as e:
+        print(f"   -> AVISO: Não foi possível ler o resultado da calculadora: {e}")
+        return None, None
+
+    def extrair_numero(rotulo):
+        encontrado = re.search(rf"{rotulo}\s*(?:R\$)?\s*([\d\.]+,\d+)", texto, re.IGNORECASE)
+        if not encontrado:
+            return None
+        return float(encontrado.group(1).replace('.', '').replace(',', '.'))
+
+    return extrair_numero("Valor corrigido na data final"), extrair_numero("Índice de correção no período")
+
+def enviar_correcao(driver):
+    """
+    Clica em 'Corrigir valor' no formulário já preenchido e aguarda a resposta do BCB.
+    Retorna o texto da mensagem de erro do BCB (ex.: mês ainda não publicado) ou None
+    se a página de resultado carregou. Se nenhuma das duas aparecer, levanta TimeoutException.
+    """
+    driver.find_element(By.CSS_SELECTOR, "input[value='Corrigir valor']").click()
+    resposta = WebDriverWait(driver, 10).until(
+        EC.presence_of_element_located((By.CSS_SELECTOR, "input[value='Imprimir'], .msgErro"))
+    )
+    if "msgErro" in (resposta.get_attribute('class') or ""):
+        return resposta.text
+    return None
+
+def corrigir_item_na_pagina(driver, item, membros, buffer=None, meses_atras=1):
+    """
+    Corrige um item usando a calculadora já aberta no driver e gera o PDF do resultado
+    para cada (item_id, item) em 'membros' (itens equivalentes compartilham a mesma correção).
+    O primeiro mês final tentado é 'meses_atras' meses antes do atual (no lote, o que funcionou
+    para o grupo anterior). Se o BCB responder que esse mês ainda não está disponível, tenta o anterior.
+    Retorna um ResultadoCorrecao.
+    """
+    inicio = time.perf_counter()
+    resultado = ResultadoCorrecao(
+        efisco=item['efisco'],
+        item_ids=[item_id for item_id, _ in membros],
+        valor_original=item['valor']
+    )
     data_origem_str = item['data_base'].strftime('%m%Y')
     
     valor_a_enviar = f"{item['valor']:.2f}".replace('.', ',')
@@ -377,71 +898,145 @@ def corrigir_valor_ipca_selenium(item, item_id, mostrar_browser=True):
 
     tentativas = 0
     max_tentativas = 2
-    try:
-        driver.get(url_calculadora)
-        WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.ID, 'selIndice'))
-        )
-        while tentativas < max_tentativas:
-            Select(driver.find_element(By.ID, 'selIndice')).select_by_value("00433IPCA")
-            driver.find_element(By.NAME, 'dataInicial').send_keys(data_origem_str)
-            
-            data_hoje = datetime.now().date()
-            data_final_str = (data_hoje - relativedelta(months=1+tentativas)).strftime('%m%Y')
-            
-            # checa se o mês para o qual está tentando atualizar é o mesmo de referencia
-            data_final_str_mes = datetime.strptime(data_final_str,'%m%Y').month
-            data_origem_str_mes = item['data_base'].month
-            if data_final_str_mes == data_origem_str_mes:
-                print(f"   -> AVISO: A data final do codigo {item["efisco"]} atingiu o mesmo mês da data base. Não é possível atualizar.")
-                break
-
-            campo_data = driver.find_element(By.NAME, 'dataFinal')
-            campo_data.clear()
-            campo_data.send_keys(data_final_str)
-
-            campo_valor = driver.find_element(By.NAME, 'valorCorrecao')
-            campo_valor.clear()
-            campo_valor.send_keys(valor_a_enviar)
-            
-            btn_corrigir = driver.find_element(By.CSS_SELECTOR, "input[value='Corrigir valor']")
-            btn_corrigir.click()
-
-            try:
-                elementos_erro = driver.find_elements(By.CLASS_NAME, "msgErro")
-                if elementos_erro:
-                    tentativas += 1
-                    print(f"   -> ERRO: {elementos_erro[0].text} para data final {data_final_str}.")
-                    print(f"\n Data alterada automaticamente para {data_hoje - relativedelta(months=1+tentativas)}.")
-                    continue
-                
+    while tentativas < max_tentativas:
+        data_hoje = datetime.now().date()
+        meses = meses_atras + tentativas
+        data_final_str = (data_hoje - relativedelta(months=meses)).strftime('%m%Y')
+        
+        # checa se o mês para o qual está tentando atualizar é o mesmo de referencia
+        data_final_str_mes = datetime.strptime(data_final_str,'%m%Y').month
+        data_origem_str_mes = item['data_base'].month
+        if data_final_str_mes == data_origem_str_mes:
+            print(f"   -> AVISO: A data final do codigo {item['efisco']} atingiu o mesmo mês da data base. Não é possível atualizar.")
+            resultado.status = 'sem_atualizacao'
+            resultado.mensagem = "Mês final igual ao mês da data base."
+            break
+
+        envios = 0
+
+        def enviar():
+            # Numa nova tentativa (falha transitória) a página pode ter navegado:
+            # recarrega o formulário, preenche de novo e busca o botão outra vez
+            nonlocal envios
+            if envios:
+                carregar_formulario(driver)
+            envios += 1
+            preencher_formulario(driver, data_origem_str, data_final_str, valor_a_enviar)
+            return enviar_correcao(driver)
+
+        # Falhas transitórias (inclusive demora da página de resultados) são repetidas
+        # pelo agendador no mesmo mês; só a mensagem de erro do BCB muda o mês final
+        try:
+            mensagem_erro = AGENDADOR_BCB.executar('correcao', enviar)
+        except Exception as e:
+            # Tentativas esgotadas: registra o erro sem perder a contagem de envios
+            print(f"   -> Erro Selenium: {e}")
+            resultado.mensagem = str(e)
+            break
+        finally:
+            resultado.tentativas += envios
+
+        if mensagem_erro:
+            tentativas += 1
+            resultado.mensagem = mensagem_erro
+            print(f"   -> ERRO: {mensagem_erro} para data final {data_final_str}.")
+            print(f"\n Data alterada automaticamente para {data_hoje - relativedelta(months=meses_atras+tentativas)}.")
+            continue
 
-                WebDriverWait(driver, 3).until( 
-                    EC.presence_of_element_located((By.CSS_SELECTOR, "input[value='Imprimir']"))
-                )
-                gerar_pdf_cdp(driver, item['efisco'], item['data_base'], PASTA_DOWNLOAD, item_id)
-                break
-            except TimeoutException:
-                print("   -> ERRO: O carregamento da página de resultados demorou mais de 3 segundos.")
-                print("   -> Tentando buscar atualização para o mês anterior.")
-                tentativas += 1
-                driver.get(url_calculadora) 
-                WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.ID, 'selIndice'))
-                )
-        return False
+        resultado.valor_corrigido, resultado.fator = ler_resultado_calculadora(driver)
+        resultado.mes_final = f"{data_final_str[:2]}/{data_final_str[2:]}"
+        resultado.meses_atras = meses
+        resultado.caminhos_pdf = gerar_pdfs_membros(driver, membros, PASTA_DOWNLOAD, buffer)
+        if len(resultado.caminhos_pdf) == len(membros):
+            resultado.status = 'sucesso'
+        else:
+            resultado.mensagem = "Falha ao gerar o PDF de evidência."
+        break
+    resultado.duracao = time.perf_counter() - inicio
+    return resultado
+
+def resultado_com_erro(item, membros, erro, inicio):
+    """Monta o ResultadoCorrecao de uma correção interrompida por exceção."""
+    return ResultadoCorrecao(
+        efisco=item['efisco'],
+        item_ids=[item_id for item_id, _ in membros],
+        valor_original=item['valor'],
+        mensagem=str(erro),
+        duracao=time.perf_counter() - inicio
+    )
 
+def corrigir_valor_ipca_selenium(item, item_id, mostrar_browser=True, membros=None, buffer=None):
+    """
+    Usa Selenium para acessar a calculadora do BCB e corrigir o valor pelo IPCA.
+    Gera o PDF do resultado e salva na pasta de downloads.
+    'membros' permite replicar o PDF para outros itens equivalentes (padrão: só o próprio item).
+    'buffer' (BufferEvidencias) mantém os PDFs em memória em vez de salvá-los na hora.
+    Retorna um ResultadoCorrecao.
+    """
+    if membros is None:
+        membros = [(item_id, item)]
+    inicio = time.perf_counter()
+    driver = iniciar_driver(mostrar_browser)
+    try:
+        abrir_calculadora(driver)
+        return corrigir_item_na_pagina(driver, item, membros, buffer)
 
     except Exception as e:
         print(f"   -> Erro Selenium: {e}")
-        return False
+        return resultado_com_erro(item, membros, e, inicio)
     finally:
         driver.quit()
 
-def concatena_pdf(catmat: str, todos_dados: list): 
+def corrigir_lote_ipca_selenium(lote, mostrar_browser=True, buffer=None):
+    """
+    Corrige vários itens mantendo a calculadora do BCB carregada em um único navegador.
+    'lote' é uma lista de grupos gerada por 'agrupar_itens_equivalentes'. Após cada resultado,
+    volta ao formulário pelo histórico e reescreve só os campos que mudaram, sem recarregar a página.
+    É um gerador: devolve (grupo, ResultadoCorrecao) ao fim de cada grupo, o que permite
+    interromper o lote entre um grupo e outro.
+    """
+    driver = iniciar_driver(mostrar_browser)
+    try:
+        pagina_pronta = False
+        # Mês final que funcionou no lote: evita repetir, a cada grupo, o envio
+        # para um mês cujo IPCA ainda não foi publicado
+        meses_atras = 1
+        for grupo in lote:
+            inicio = time.perf_counter()
+            try:
+                if not pagina_pronta:
+                    abrir_calculadora(driver)
+                    pagina_pronta = True
+                resultado = corrigir_item_na_pagina(driver, grupo, grupo['membros'], buffer, meses_atras)
+                if resultado.meses_atras:
+                    meses_atras = resultado.meses_atras
+            except Exception as e:
+                print(f"   -> Erro Selenium: {e}")
+                resultado = resultado_com_erro(grupo, grupo['membros'], e, inicio)
+                # Estado da página desconhecido: recarrega antes do próximo item
+                pagina_pronta = False
+
+            if pagina_pronta and resultado.status == 'sucesso':
+                # Falha ao voltar ao formulário não invalida a correção já feita
+                try:
+                    voltar_formulario(driver)
+                except Exception as e:
+                    print(f"   -> Erro ao voltar ao formulário: {e}")
+                    pagina_pronta = False
+            else:
+                # A página pode ter ficado no resultado (ex.: falha ao gerar algum PDF):
+                # recarrega antes do próximo grupo
+                pagina_pronta = False
+            yield grupo, resultado
+    finally:
+        driver.quit()
+
+def concatena_pdf(catmat: str, todos_dados: list, evidencias: dict | None = None, buffer=None): 
     """
     Concatena o relatório original (se existir) com todos os PDFs de preço gerados
     para o EFISCO (catmat) especificado, na ordem do Excel.
+    'evidencias' ({item_id: caminho}, ver ResumoExecucao.evidencias) evita procurar os PDFs no disco.
+    Com 'buffer', os PDFs ainda em memória são anexados direto e liberados após a concatenação.
     """
     
     # 1. Filtra a ordem dos item_id (1, 2, 3...) do Excel para este EFISCO
@@ -456,10 +1051,12 @@ def concatena_pdf(catmat: str, todos_dados: list):
 
     # Itera pelos item_id na ordem do Excel (e, portanto, da lista todos_dados)
     for item_id in ordem_item_ids:
-        
-        padrao_busca = os.path.join(PASTA_DOWNLOAD, f"EFISCO_{catmat}_item_{item_id}Correcao_IPCA_*.pdf")
-        
-        arquivos_encontrados = glob.glob(padrao_busca)
+
+        if evidencias is not None:
+            arquivos_encontrados = [evidencias[item_id]] if item_id in evidencias else []
+        else:
+            padrao_busca = os.path.join(PASTA_DOWNLOAD, f"EFISCO_{catmat}_item_{item_id}Correcao_IPCA_*.pdf")
+            arquivos_encontrados = glob.glob(padrao_busca)
         
         if arquivos_encontrados:
             # Adiciona o primeiro arquivo encontrado para aquele item_id
@@ -480,24 +1077,177 @@ def concatena_pdf(catmat: str, todos_dados: list):
     merger.append(caminho_relatorio_base)
 
     for caminho_arquivo in arquivos_ordenados_caminho:
-        merger.append(caminho_arquivo)
+        merger.append(buffer.abrir(caminho_arquivo) if buffer is not None else caminho_arquivo)
 
     caminho_saida = os.path.join(PASTA_OUTPUT, f"{catmat}_COMPLETO.pdf")
     merger.write(caminho_saida)
     merger.close()
+
+    if buffer is not None:
+        for caminho_arquivo in arquivos_ordenados_caminho:
+            buffer.liberar(caminho_arquivo)
     return True
 
 
-def renomeia_detalhado_catmat(caminho):
+def chave_objeto_pdf(valor):
+    """Representação comparável de um valor PDF (referências indiretas entram pelo número do objeto)."""
+    if not isinstance(valor, pikepdf.Object):
+        # Números e booleanos já vêm como tipos do Python
+        return repr(valor)
+    if valor.is_indirect:
+        return ('ref', valor.objgen)
+    if isinstance(valor, pikepdf.Dictionary):
+        return tuple(sorted((str(k), chave_objeto_pdf(v)) for k, v in valor.items()))
+    if isinstance(valor, pikepdf.Array):
+        return tuple(chave_objeto_pdf(v) for v in valor)
+    return repr(valor)
+
+def substituir_referencias_pdf(objeto, substituicoes):
+    """Troca, dentro de 'objeto' (e dos seus valores diretos), as referências para objetos duplicados."""
+    if isinstance(objeto, pikepdf.Array):
+        posicoes = range(len(objeto))
+    elif isinstance(objeto, (pikepdf.Dictionary, pikepdf.Stream)):
+        posicoes = list(objeto.keys())
+    else:
+        return
+    for posicao in posicoes:
+        valor = objeto[posicao]
+        if not isinstance(valor, pikepdf.Object):
+            continue
+        if valor.is_indirect:
+            if valor.objgen in substituicoes:
+                objeto[posicao] = substituicoes[valor.objgen]
+        elif isinstance(valor, (pikepdf.Dictionary, pikepdf.Array)):
+            substituir_referencias_pdf(valor, substituicoes)
+
+def deduplicar_streams_pdf(pdf):
     """
-    Renomeia os PDFs na pasta 'relatorio_detalhado' com base no código CATMAT extraído do próprio PDF.
-    Usado para o relatório detalhado baixado do Compras.gov.br"""
-    for arq in os.listdir(caminho):
-        catmat = buscar_codigo(os.path.join(caminho, arq))
-        if arq.startswith(f"{catmat}"):
+    Mantém uma única cópia de streams idênticos (fontes, logos e imagens que cada evidência
+    do BCB traz repetidos) e aponta todas as referências para ela.
+    Retorna a quantidade de streams removidos.
+    """
+    canonicos = {}
+    substituicoes = {}
+    for objeto in pdf.objects:
+        if not isinstance(objeto, pikepdf.Stream):
             continue
-        novo_nome = f"{catmat}.pdf"
-        os.rename(os.path.join(caminho, arq), os.path.join(caminho, novo_nome))
+        dicionario = tuple(sorted(
+            (str(k), chave_objeto_pdf(v)) for k, v in objeto.stream_dict.items() if k != '/Length'
+        ))
+        chave = (hashlib.sha256(objeto.read_raw_bytes()).digest(), dicionario)
+        original = canonicos.setdefault(chave, objeto)
+        if original.objgen != objeto.objgen:
+            substituicoes[objeto.objgen] = original
+
+    if substituicoes:
+        for objeto in pdf.objects:
+            substituir_referencias_pdf(objeto, substituicoes)
+        substituir_referencias_pdf(pdf.trailer, substituicoes)
+    return len(substituicoes)
+
+def otimizar_pdf(caminho, nivel="equilibrado"):
+    """
+    Reduz o tamanho do PDF final, regravando-o no mesmo caminho.
+    Níveis (tamanho x tempo):
+    - 'rapido': comprime os streams e agrupa objetos em object streams;
+    - 'equilibrado': também remove streams idênticos entre os documentos anexados;
+    - 'maximo': também recomprime todos os streams e lineariza o arquivo (abertura rápida na web).
+    Sem o pikepdf instalado, o arquivo não é alterado (reconstruí-lo com PyPDF2 perderia
+    marcadores e metadados do relatório base e quase não reduz o tamanho).
+    Retorna (bytes_antes, bytes_depois).
+    """
+    if nivel not in NIVEIS_OTIMIZACAO_PDF:
+        raise ValueError(f"Nível de otimização inválido: {nivel}")
+    tamanho_antes = os.path.getsize(caminho)
+
+    if pikepdf is None:
+        print(f"   -> AVISO: pikepdf não instalado; otimização de {os.path.basename(caminho)} ignorada.")
+        return tamanho_antes, tamanho_antes
+
+    with pikepdf.open(caminho) as pdf:
+        if nivel in ("equilibrado", "maximo"):
+            removidos = deduplicar_streams_pdf(pdf)
+            if removidos:
+                print(f"   -> {removidos} objetos duplicados removidos de {os.path.basename(caminho)}")
+        buffer = io.BytesIO()
+        pdf.save(
+            buffer,
+            compress_streams=True,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            recompress_flate=(nivel == "maximo"),
+            linearize=(nivel == "maximo")
+        )
+
+    # Só substitui o arquivo se a versão otimizada for de fato menor
+    if buffer.tell() < tamanho_antes:
+        with open(caminho, 'wb') as f:
+            f.write(buffer.getvalue())
+    return tamanho_antes, os.path.getsize(caminho)
+
+def renomeia_detalhado_catmat(caminho, max_processos=None):
+    """
+    Renomeia os PDFs na pasta 'relatorio_detalhado' com base no código CATMAT extraído do próprio PDF.
+    Usado para o relatório detalhado baixado do Compras.gov.br
+    A extração roda em paralelo (no máximo um processo por núcleo e por arquivo). Se dois PDFs
+    tiverem o mesmo código, só um fica com o nome '{catmat}.pdf' e os demais mantêm o nome original,
+    para não haver sobrescrita.
+    Retorna uma lista de mensagens (uma por arquivo) com o resultado e o tempo de extração.
+    """
+    arquivos = sorted(arq for arq in os.listdir(caminho) if arq.lower().endswith(".pdf"))
+    caminhos = [os.path.join(caminho, arq) for arq in arquivos]
+
+    # Poucos arquivos não compensam o custo de iniciar os processos
+    if len(caminhos) <= 2 or max_processos == 1:
+        extraidos = [extrair_codigo_arquivo(c) for c in caminhos]
+    else:
+        processos = min(len(caminhos), os.cpu_count() or 1, max_processos or len(caminhos))
+        try:
+            # 'spawn' explícito: chamado de uma thread do Gradio, 'fork' de processo com várias
+            # threads pode travar; é também o modo do Windows e do executável
+            contexto = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=processos, mp_context=contexto) as executor:
+                extraidos = list(executor.map(extrair_codigo_arquivo, caminhos))
+        except Exception as e:
+            print(f"   -> AVISO: Extração paralela indisponível ({e}). Extraindo em sequência.")
+            extraidos = [extrair_codigo_arquivo(c) for c in caminhos]
+
+    # Define qual arquivo fica com cada código: o que já se chama '{catmat}.pdf', senão o primeiro da lista
+    dono_codigo = {}
+    for arq, catmat, _, _ in extraidos:
+        if catmat and arq == f"{catmat}.pdf":
+            dono_codigo[catmat] = arq
+    for arq, catmat, _, _ in extraidos:
+        if catmat:
+            dono_codigo.setdefault(catmat, arq)
+
+    # Arquivos que continuam com o nome atual não podem ser sobrescritos
+    saindo = {arq for arq, catmat, _, _ in extraidos if catmat and dono_codigo[catmat] == arq and arq != f"{catmat}.pdf"}
+    permanecem = set(arquivos) - saindo
+
+    relatorio = []
+    renomear = []
+    for arq, catmat, duracao, erro in extraidos:
+        if not catmat:
+            relatorio.append(f"{arq}: código não encontrado ({erro}) [{duracao:.2f}s]")
+        elif dono_codigo[catmat] != arq:
+            relatorio.append(f"{arq}: COLISÃO - código {catmat} já pertence a {dono_codigo[catmat]}; arquivo não renomeado [{duracao:.2f}s]")
+        elif arq not in saindo:
+            relatorio.append(f"{arq}: já nomeado com o código {catmat} [{duracao:.2f}s]")
+        elif f"{catmat}.pdf" in permanecem:
+            relatorio.append(f"{arq}: COLISÃO - {catmat}.pdf já existe e não será sobrescrito [{duracao:.2f}s]")
+        else:
+            renomear.append((arq, f"{catmat}.pdf"))
+            relatorio.append(f"{arq} -> {catmat}.pdf [{duracao:.2f}s]")
+
+    # Renomeia em duas etapas para um arquivo não sobrescrever outro que ainda será renomeado
+    for arq, _ in renomear:
+        os.rename(os.path.join(caminho, arq), os.path.join(caminho, f"{arq}.renomeando"))
+    for arq, novo_nome in renomear:
+        os.rename(os.path.join(caminho, f"{arq}.renomeando"), os.path.join(caminho, novo_nome))
+
+    for linha in relatorio:
+        print(f"   -> {linha}")
+    return relatorio
 
 
 def renomeia_fonte_precos(caminho):
@@ -0,0 +1,74 @@
+"""
+Extração do código CATMAT dos PDFs do Compras.gov.br.
+Fica separada de automacao_core e só depende de PyPDF2 e re, para que a função executada
+nos processos auxiliares de 'renomeia_detalhado_catmat' não exija importar Selenium, camelot etc.
+"""
+import os
+import re
+import time
+from functools import lru_cache
+from PyPDF2 import PdfReader
+
+def read_pdf_text(file_path):
+    """Lê o texto de um arquivo PDF e retorna como uma string."""
+    texto_completo = ""
+    try:
+        with open(file_path, 'rb') as file:
+            reader = PdfReader(file)
+            for page in reader.pages:
+                texto_completo += page.extract_text() + "\n"
+    except Exception as e:
+        print(f"Erro ao ler o PDF {file_path}: {e}")
+    return texto_completo
+
+@lru_cache(maxsize=None)
+def compilar_padrao_codigo(palavra_chave_1, palavra_chave_2, distancia_max_chars):
+    """
+    Compila (uma única vez por combinação de parâmetros) a expressão regular usada em 'buscar_codigo'.
+    """
+    # 1. Escapar caracteres especiais para RegEx
+    chave_1_escapada = re.escape(palavra_chave_1)
+    chave_2_escapada = re.escape(palavra_chave_2)
+    
+    # 2. Construir a expressão regular
+    # Padrão: CHAVE_1, seguida por 0 a N caracteres (qualquer coisa), seguida por CHAVE_2
+    return re.compile(
+        # Captura CHAVE_1
+        rf"({chave_1_escapada})"
+        # Captura o contexto entre (distância máxima de caracteres)
+        r"([\s\S]{0," + str(distancia_max_chars) + r"}?)"
+        # Captura CHAVE_2
+        rf"({chave_2_escapada})",
+        re.IGNORECASE | re.DOTALL # Ignora maiúsculas/minúsculas e permite que . case com newline
+    )
+
+def buscar_codigo(file_path, palavra_chave_1= "Quantidade", palavra_chave_2= "-", distancia_max_chars=100):
+    """
+    Busca a palavra_chave_1 próxima à palavra_chave_2.
+    Retorna o trecho de texto encontrado.
+    Baseado no formato do PDF gerado pelo Compras.gov.br
+    """
+    texto = read_pdf_text(file_path)
+    padrao = compilar_padrao_codigo(palavra_chave_1, palavra_chave_2, distancia_max_chars)
+    
+    # 3. Executar a busca (só a primeira ocorrência é usada)
+    match = padrao.search(texto)
+    if match is None:
+        raise ValueError(f"Código não encontrado no PDF {os.path.basename(file_path)}.")
+    
+    # match.group(0) contém o trecho completo: Chave 1 + Contexto + Chave 2
+    codigo = match.group(0).strip().split("\n")[1]
+    codigo = codigo.split(" ")[0].strip()
+    return codigo
+
+def extrair_codigo_arquivo(caminho_arquivo):
+    """
+    Extrai o CATMAT de um PDF detalhado (executado nos processos auxiliares).
+    Retorna (nome do arquivo, código ou None, duração em segundos, mensagem de erro).
+    """
+    inicio = time.perf_counter()
+    try:
+        codigo, erro = buscar_codigo(caminho_arquivo), ""
+    except Exception as e:
+        codigo, erro = None, str(e)
+    return os.path.basename(caminho_arquivo), codigo, time.perf_counter() - inicio, erro